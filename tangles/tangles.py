@@ -1,6 +1,7 @@
-from copy import deepcopy
 from itertools import combinations
 from bitarray import bitarray
+from bitarray.util import count_and
+import numpy as np
 
 from .utils import subset
 from .data_types import Cuts
@@ -15,6 +16,36 @@ def pad_bitarray(b, n):
     return b
 
 
+def to_bitarray(cut):
+    """
+    Converts a boolean numpy array to a bitarray.
+
+    The bits are packed from the raw bytes of the array in C, which is much
+    faster than building the bitarray from a python list.
+    """
+    b = bitarray()
+    b.pack(np.ascontiguousarray(cut, dtype=bool).tobytes())
+    return b
+
+
+def pack_cuts(values):
+    """
+    Converts every cut (a row of values) to a bitarray.
+
+    Parameters
+    ----------
+    values: ndarray of shape (n_cuts, n_points)
+        The cuts, a row is one cut
+
+    Returns
+    -------
+    packed_cuts: list of bitarray
+        The cuts as bitarrays, in the order of the rows of values
+    """
+    values = np.asarray(values, dtype=bool)
+    return [to_bitarray(cut) for cut in values]
+
+
 class Tangle(dict):
     """
     This class represents an oriented cut as a couple of lists and a dictionary.
@@ -89,7 +120,9 @@ class Tangle(dict):
             If it is possible to add we return the new specification otherwise we return None
         """
 
-        core = deepcopy(self._core)
+        # The cuts in the core are never modified in place (and are shared with
+        # the packed cuts of the tree), so copying the list is enough.
+        core = list(self._core)
         specification = self._specification.copy()
 
         pad_bitarray(specification, new_cut_id + 1)
@@ -111,11 +144,11 @@ class Tangle(dict):
             if new_cut.count() < min_size:
                 return None
         elif len(core) == 1:
-            if (core[0] & new_cut).count() < min_size:
+            if count_and(core[0], new_cut) < min_size:
                 return None
         else:
             for core1, core2 in combinations(core, 2):
-                if (core1 & core2 & new_cut).count() < min_size:
+                if count_and(core1 & core2, new_cut) < min_size:
                     return None
 
         core.append(new_cut)
@@ -124,7 +157,7 @@ class Tangle(dict):
         return Tangle(self._cuts, core, specification)
 
 
-def core_algorithm(tree, current_cuts, idx_current_cuts):
+def core_algorithm(tree, idx_current_cuts):
     """
     Algorithm iteratively adding cuts to the tree
 
@@ -132,10 +165,9 @@ def core_algorithm(tree, current_cuts, idx_current_cuts):
     ----------
     tree: TangleTree
         The binary tree the cut should be added to
-    current_cuts: list
-        Current cuts to add
     idx_current_cuts: list
-        Indices of the cuts giving their layer in the tree (based on the order induced by the cost)
+        Indices of the cuts to add, giving their layer in the tree (based on the order induced by the cost).
+        The cuts themselves are the packed cuts of the tree at these indices.
 
     Returns
     -------
@@ -143,8 +175,8 @@ def core_algorithm(tree, current_cuts, idx_current_cuts):
         We return the new tree with added cuts if it is possible
     """
 
-    for idx_cut, cut in zip(idx_current_cuts, current_cuts):
-        could_add = tree.add_cut(cut=cut, cut_id=idx_cut)
+    for idx_cut in idx_current_cuts:
+        could_add = tree.add_cut(cut_id=idx_cut)
         if could_add is False:
             return None
 
@@ -1,3 +1,4 @@
+from collections import deque
 from pathlib import Path
 from typing import Optional
 import matplotlib.pyplot as plt
@@ -5,20 +6,41 @@ import matplotlib.pyplot as plt
 import networkx as nx
 from networkx.drawing.nx_pydot import graphviz_layout
 
-import bitarray as ba
 import numpy as np
 from PIL import Image
 from .plotting import plot_soft_predictions
 
-from .tangles import Tangle, core_algorithm
-from .utils import compute_hard_predictions, matching_items, Orientation, normalize
+from .tangles import Tangle, core_algorithm, pack_cuts
+from .utils import (
+    compute_hard_predictions,
+    compute_weight,
+    Orientation,
+)
 from .cost_functions import BipartitionSimilarity
 from .data_types import Cuts
 
 MAX_CLUSTERS = 50
 
+# Frame states of the explicit stacks used to traverse the tree.
+_ENTER = 0
+_AFTER_LEFT = 1
+_MERGE = 2
+
 
 class TangleNode(object):
+    # Trees hold many nodes, slots save the per instance __dict__.
+    __slots__ = (
+        "parent",
+        "right_child",
+        "left_child",
+        "is_left_child",
+        "splitting",
+        "did_split",
+        "last_cut_added_id",
+        "last_cut_added_orientation",
+        "tangle",
+    )
+
     def __init__(
         self,
         parent,
@@ -79,9 +101,19 @@ class TangleNode(object):
 
 
 class ContractedTangleNode(TangleNode):
+    __slots__ = (
+        "characterizing_cuts",
+        "characterizing_cuts_left",
+        "characterizing_cuts_right",
+        "is_left_child_deleted",
+        "is_right_child_deleted",
+        "p",
+        "image",
+    )
+
     def __init__(self, parent, node):
 
-        attributes = node.__dict__
+        attributes = {name: getattr(node, name) for name in TangleNode.__slots__}
         super().__init__(**attributes)
 
         self.parent = parent
@@ -204,13 +236,19 @@ class TangleTree(object):
         self.is_empty = True
         self.agreement = agreement
 
+        # All cuts are packed to bitarrays once, in both orientations, so adding
+        # a cut to a tangle only has to look them up by the cut id.
+        self.packed_cuts = pack_cuts(cuts.values)
+        self.packed_neg_cuts = [~packed_cut for packed_cut in self.packed_cuts]
+
     def __str__(self):  # pragma: no cover
         return str(self.root)
 
     # function to add a single cut to the tree
+    # the cut is looked up by cut_id in the packed cuts of the tree
     # function checks if tree is empty
     # --- stops if number of active leaves gets too large ! ---
-    def add_cut(self, cut, cut_id):
+    def add_cut(self, cut_id):
         if self.max_clusters and len(self.active) >= self.max_clusters:
             print("Stopped since there are more then 50 leaves already.")
             return False
@@ -218,12 +256,16 @@ class TangleTree(object):
         current_active = self.active
         self.active = []
 
+        # The cut in both orientations does not depend on the node it is added to.
+        new_cut = self.packed_cuts[cut_id]
+        new_cut_neg = self.packed_neg_cuts[cut_id]
+
         could_add_one = False
         # Go through all nodes that are on the order of the preceding cut.
         # Check if we can add the current cut to them.
         for current_node in current_active:
             could_add_node, did_split, is_maximal = self._add_children_to_node(
-                current_node, cut, cut_id
+                current_node, new_cut, new_cut_neg, cut_id
             )
             could_add_one = could_add_one or could_add_node
 
@@ -238,22 +280,19 @@ class TangleTree(object):
 
         return could_add_one
 
-    def _add_children_to_node(self, current_node, cut, cut_id):
+    def _add_children_to_node(self, current_node, cut, not_cut, cut_id):
         old_tangle = current_node.tangle
 
-        if cut.dtype is not bool:
-            cut = cut.astype(bool)
-
         # Tangle with the cut added in present orientation.
         new_tangle_true = old_tangle.add(
-            new_cut=ba.bitarray(cut.tolist()),
+            new_cut=cut,
             new_cut_id=cut_id,
             orientation=True,
             min_size=self.agreement,
         )
         # Tangle with the cut added in opposite orientation.
         new_tangle_false = old_tangle.add(
-            new_cut=ba.bitarray((~cut).tolist()),
+            new_cut=not_cut,
             new_cut_id=cut_id,
             orientation=False,
             min_size=self.agreement,
@@ -385,16 +424,25 @@ class ContractedTangleTree(TangleTree):
                 )
             )
 
+    # Post-order walk on an explicit stack. A splitting node is visited three
+    # times: before its children, after its left and after its right subtree.
+    # A parent that became a leaf is pushed again instead of recursing into it.
     def _delete_noise_clusters(self, node, depth):
         if depth == 0:
             return
 
-        if node.is_leaf():
-            if node.parent is None:
-                Warning(
-                    "This node is a leaf and the root at the same time. This tree is empty!"
-                )
-            else:
+        stack = [(_ENTER, node)]
+
+        while stack:
+            state, node = stack.pop()
+
+            if state == _ENTER and node.is_leaf():
+                if node.parent is None:
+                    Warning(
+                        "This node is a leaf and the root at the same time. This tree is empty!"
+                    )
+                    continue
+
                 node_id = node.last_cut_added_id
                 parent_id = node.parent.last_cut_added_id
 
@@ -410,16 +458,20 @@ class ContractedTangleTree(TangleTree):
                         node.parent.right_child = None
                         if node.parent.is_left_child_deleted:
                             self.maximals.append(node.parent)
-                            self._delete_noise_clusters(node.parent, depth)
+                            stack.append((_ENTER, node.parent))
 
-        else:
-            self._delete_noise_clusters(node.left_child, depth)
-            if not node.splitting:
-                self.splitting.remove(node)
+            elif state == _ENTER:
+                stack.append((_AFTER_LEFT, node))
+                stack.append((_ENTER, node.left_child))
+
+            elif state == _AFTER_LEFT:
+                if not node.splitting:
+                    self.splitting.remove(node)
 
-            self._delete_noise_clusters(node.right_child, depth)
+                stack.append((_MERGE, node))
+                stack.append((_ENTER, node.right_child))
 
-            if not node.splitting:
+            elif not node.splitting:
                 if node.parent is None:
                     if node.right_child is not None:
                         self.root = node.right_child
@@ -460,45 +512,56 @@ class ContractedTangleTree(TangleTree):
     # As python has no Tail Call Optimization, it is more beneficial to
     # use contract_subtree in an iterative fashion. Else we quickly
     # get in the territory of a stack explosion.
+    # The traversal is a post-order walk on an explicit stack: a splitting node
+    # is pushed as a merge frame below its children, so it is only finalized
+    # once both contracted children are on the results stack.
     def _contract_subtree_iterative(self, parent, node):
-        current_node = node
+        results = []
+        stack = [(_ENTER, parent, node)]
 
-        while True:
-            if current_node.left_child is None and current_node.right_child is None:
-                # is leaf so create new node
-                contracted_node = ContractedTangleNode(parent=parent, node=current_node)
-                self.maximals.append(contracted_node)
-                return contracted_node
-            elif (
-                current_node.left_child is not None
-                and current_node.right_child is not None
-            ):
-                # is splitting so create new node
-                contracted_node = ContractedTangleNode(parent=parent, node=current_node)
+        while stack:
+            state, contracted_parent, current_node = stack.pop()
+
+            if state == _MERGE:
+                contracted_node = contracted_parent
+                contracted_right_child = results.pop()
+                contracted_left_child = results.pop()
 
-                contracted_left_child = self._contract_subtree_iterative(
-                    parent=contracted_node, node=current_node.left_child
-                )
                 contracted_node.left_child = contracted_left_child
                 # let it know that it is a left child!
                 contracted_node.left_child.is_left_child = True
-
-                contracted_right_child = self._contract_subtree_iterative(
-                    parent=contracted_node, node=current_node.right_child
-                )
                 contracted_node.right_child = contracted_right_child
                 # let it know that it is a right child!
                 contracted_node.right_child.is_left_child = False
 
                 self.splitting.append(contracted_node)
+                results.append(contracted_node)
+                continue
 
-                return contracted_node
-            else:
+            # skip the nodes that did not split
+            while (current_node.left_child is None) != (
+                current_node.right_child is None
+            ):
                 if current_node.left_child is not None:
                     current_node = current_node.left_child
-                elif current_node.right_child is not None:
+                else:
                     current_node = current_node.right_child
 
+            contracted_node = ContractedTangleNode(
+                parent=contracted_parent, node=current_node
+            )
+            if current_node.left_child is None:
+                # is leaf so the contracted node is finished
+                self.maximals.append(contracted_node)
+                results.append(contracted_node)
+            else:
+                # is splitting so contract the children first, left before right
+                stack.append((_MERGE, contracted_node, None))
+                stack.append((_ENTER, contracted_node, current_node.right_child))
+                stack.append((_ENTER, contracted_node, current_node.left_child))
+
+        return results.pop()
+
     def _contract_subtree(self, parent, node):
         return self._contract_subtree_iterative(parent, node)
 
@@ -559,96 +622,171 @@ def process_split(node):
     characterizing_cuts_left = node.left_child.characterizing_cuts
     characterizing_cuts_right = node.right_child.characterizing_cuts
 
-    orientation_left = node.left_child.tangle.get_specification()
-    orientation_right = node.right_child.tangle.get_specification()
+    # the specifications are read as one slice of the new relevant cuts each
+    last_id_left = node.left_child.last_cut_added_id
+    last_id_right = node.right_child.last_cut_added_id
+    orientation_left = node.left_child.tangle.get_specification()[
+        node_id + 1 : last_id_left + 1
+    ]
+    orientation_right = node.right_child.tangle.get_specification()[
+        node_id + 1 : last_id_right + 1
+    ]
 
     # add new relevant cuts
-    for id_cut in range(node_id + 1, node.left_child.last_cut_added_id + 1):
-        characterizing_cuts_left[id_cut] = Orientation(orientation_left[id_cut])
-
-    for id_cut in range(node_id + 1, node.right_child.last_cut_added_id + 1):
-        characterizing_cuts_right[id_cut] = Orientation(orientation_right[id_cut])
+    for id_cut, orientation in zip(
+        range(node_id + 1, last_id_left + 1), orientation_left
+    ):
+        characterizing_cuts_left[id_cut] = Orientation(orientation)
 
-    id_not_in_both = (
-        characterizing_cuts_left.keys() | characterizing_cuts_right.keys()
-    ).difference(characterizing_cuts_left.keys() & characterizing_cuts_right.keys())
+    for id_cut, orientation in zip(
+        range(node_id + 1, last_id_right + 1), orientation_right
+    ):
+        characterizing_cuts_right[id_cut] = Orientation(orientation)
+
+    # single sweep over the left cuts, sorting them by how the right subtree orients them
+    id_only_left = []
+    id_cuts_oriented_same_way = []
+    for id_cut, orientation in characterizing_cuts_left.items():
+        orientation_right = characterizing_cuts_right.get(id_cut)
+        if orientation_right is None:
+            id_only_left.append(id_cut)
+        elif orientation_right == orientation:
+            id_cuts_oriented_same_way.append(id_cut)
+
+    id_only_right = [
+        id_cut
+        for id_cut in characterizing_cuts_right
+        if id_cut not in characterizing_cuts_left
+    ]
 
     # if cuts are not oriented in both subtrees delete
-    for id_cut in id_not_in_both:
-        characterizing_cuts_left.pop(id_cut, None)
-        characterizing_cuts_right.pop(id_cut, None)
-
-    # characterizing cuts of the current node
-    characterizing_cuts = {**characterizing_cuts_left, **characterizing_cuts_right}
-
-    id_cuts_oriented_same_way = matching_items(
-        characterizing_cuts_left, characterizing_cuts_right
-    )
+    for id_cut in id_only_left:
+        characterizing_cuts_left.pop(id_cut)
+    for id_cut in id_only_right:
+        characterizing_cuts_right.pop(id_cut)
 
     # if they are oriented in the same way they are not relevant for distungishing but might be for 'higher' nodes
     # delete in the left and right parts but keep in the characteristics of the current node
+    # the cuts that are oriented in both trees but in different directions are never added to the current node since
+    # they do not affect higher nodes anymore
+    characterizing_cuts = {}
     for id_cut in id_cuts_oriented_same_way:
-        characterizing_cuts[id_cut] = characterizing_cuts_left[id_cut]
-        characterizing_cuts_left.pop(id_cut)
+        characterizing_cuts[id_cut] = characterizing_cuts_left.pop(id_cut)
         characterizing_cuts_right.pop(id_cut)
 
-    id_cuts_oriented_both_ways = (
-        characterizing_cuts_left.keys() & characterizing_cuts_right.keys()
-    )
-
-    # remove the cuts that are oriented in both trees but in different directions from the current node since they do
-    # not affect higher nodes anymore
-    for id_cut in id_cuts_oriented_both_ways:
-        characterizing_cuts.pop(id_cut)
-
     node.characterizing_cuts_left = characterizing_cuts_left
     node.characterizing_cuts_right = characterizing_cuts_right
     node.characterizing_cuts = characterizing_cuts
 
 
-def compute_soft_predictions_node(characterizing_cuts, cuts, weight):
-    sum_p = np.zeros(len(cuts.values[0]))
+def compute_soft_predictions_node(characterizing_cuts, cuts, weight, out=None):
+    """
+    Computes the weighted sum of the (oriented) characterizing cuts for every point.
 
-    for i, o in characterizing_cuts.items():
-        if o.direction == "left":
-            sum_p += np.array(cuts.values[i]) * weight[i]
-        elif o.direction == "right":
-            sum_p += np.array(~cuts.values[i]) * weight[i]
+    Every cut adds its weight to the points on its oriented side, a cut oriented to
+    the right uses ~cut = 1 - cut. Only the characterizing cuts are converted to
+    floats. If out is given, the sum is written to it instead of a newly allocated
+    array.
+    """
+    ids = list(characterizing_cuts)
+    cut_matrix = cuts.values[ids].astype(weight.dtype)
+
+    # the rows of cut_matrix are the characterizing cuts in order
+    return _weighted_sum_of_cuts(
+        dict(enumerate(characterizing_cuts.values())),
+        weight[ids],
+        cut_matrix,
+        1 - cut_matrix,
+        out=out,
+    )
 
-    return sum_p
 
+def _weighted_sum_of_cuts(
+    characterizing_cuts, weight, cut_matrix, neg_cut_matrix, out=None, tmp=None
+):
+    # Only non-negative terms are summed, one cut after the other in the order of the
+    # characterizing cuts, so points on no oriented side stay exactly 0 and tied
+    # points stay exactly tied. cut_matrix and neg_cut_matrix = 1 - cut_matrix have
+    # to be float matrices in the dtype of the weights.
+    nb_points = cut_matrix.shape[1]
+    if out is None:
+        out = np.empty(nb_points, dtype=weight.dtype)
+    if tmp is None:
+        tmp = np.empty(nb_points, dtype=weight.dtype)
+
+    out.fill(0)
+    for id_cut, orientation in characterizing_cuts.items():
+        if orientation.direction == "left":
+            np.multiply(cut_matrix[id_cut], weight[id_cut], out=tmp)
+        elif orientation.direction == "right":
+            np.multiply(neg_cut_matrix[id_cut], weight[id_cut], out=tmp)
+        else:
+            continue
+        out += tmp
 
-def compute_soft_predictions_children(node, cuts, weight, verbose=0):
-    _, nb_points = cuts.values.shape
+    return out
 
-    if node.parent is None:
-        node.p = np.ones(nb_points)
 
-    if node.left_child is not None and node.right_child is not None:
+def compute_soft_predictions_children(node, cuts, weight):
+    _, nb_points = cuts.values.shape
 
-        unnormalized_p_left = compute_soft_predictions_node(
-            characterizing_cuts=node.characterizing_cuts_left, cuts=cuts, weight=weight
+    # The whole pass is computed in the dtype of the weights.
+    if node.parent is None:
+        node.p = np.ones(nb_points, dtype=weight.dtype)
+
+    cut_matrix = cuts.values.astype(weight.dtype)
+    neg_cut_matrix = 1 - cut_matrix
+
+    # Scratch buffers of length nb_points reused for every node, the cuts are
+    # accumulated in place, so the only arrays allocated per node are the p of the
+    # children.
+    unnormalized_p_left = np.empty(nb_points, dtype=weight.dtype)
+    unnormalized_p_right = np.empty(nb_points, dtype=weight.dtype)
+    weighted_cut = np.empty(nb_points, dtype=weight.dtype)
+    total_p = np.empty(nb_points, dtype=weight.dtype)
+    has_p = np.empty(nb_points, dtype=bool)
+
+    # Breadth first traversal, every splitting node hands its p to its children.
+    nodes = deque([node])
+    while nodes:
+        node = nodes.popleft()
+        if node.left_child is None or node.right_child is None:
+            continue
+
+        _weighted_sum_of_cuts(
+            node.characterizing_cuts_left,
+            weight,
+            cut_matrix,
+            neg_cut_matrix,
+            out=unnormalized_p_left,
+            tmp=weighted_cut,
         )
-        unnormalized_p_right = compute_soft_predictions_node(
-            characterizing_cuts=node.characterizing_cuts_right, cuts=cuts, weight=weight
+        _weighted_sum_of_cuts(
+            node.characterizing_cuts_right,
+            weight,
+            cut_matrix,
+            neg_cut_matrix,
+            out=unnormalized_p_right,
+            tmp=weighted_cut,
         )
 
-        # normalize the ps
-        total_p = unnormalized_p_left + unnormalized_p_right
+        # normalize the ps, the sums only add non-negative terms, so points without
+        # weight on either side are exactly 0 on both sides and keep p = 0
+        np.add(unnormalized_p_left, unnormalized_p_right, out=total_p)
+        np.greater(total_p, 0, out=has_p)
 
-        p_left = unnormalized_p_left / total_p
-        p_right = unnormalized_p_right / total_p
+        p_left = np.divide(
+            unnormalized_p_left, total_p, out=unnormalized_p_left, where=has_p
+        )
+        p_right = np.divide(
+            unnormalized_p_right, total_p, out=unnormalized_p_right, where=has_p
+        )
 
         node.left_child.p = p_left * node.p
         node.right_child.p = p_right * node.p
 
-        compute_soft_predictions_children(
-            node=node.left_child, cuts=cuts, weight=weight, verbose=verbose
-        )
-
-        compute_soft_predictions_children(
-            node=node.right_child, cuts=cuts, weight=weight, verbose=verbose
-        )
+        nodes.append(node.left_child)
+        nodes.append(node.right_child)
 
 
 def tangle_computation(cuts, agreement, verbose):
@@ -674,16 +812,17 @@ def tangle_computation(cuts, agreement, verbose):
     tangles_tree = TangleTree(agreement=agreement, cuts=cuts)
     old_order = None
 
+    # The cuts of one order are contiguous when sorted by cost (usually they
+    # already are), so the boundaries of all orders come from a single search.
+    idx_sorted = np.argsort(cuts.costs, kind="stable")
     unique_orders = np.unique(cuts.costs)
+    bounds = np.searchsorted(cuts.costs[idx_sorted], unique_orders, side="right")
+    prev_bound = 0
 
-    for order in unique_orders:
+    for order, bound in zip(unique_orders, bounds):
 
-        if old_order is None:
-            idx_cuts_order_i = np.where(cuts.costs <= order)[0]
-        else:
-            idx_cuts_order_i = np.where(
-                np.all([cuts.costs > old_order, cuts.costs <= order], axis=0)
-            )[0]
+        idx_cuts_order_i = idx_sorted[prev_bound:bound]
+        prev_bound = bound
 
         if len(idx_cuts_order_i) > 0:
 
@@ -695,10 +834,8 @@ def tangle_computation(cuts, agreement, verbose):
                     flush=True,
                 )
 
-            cuts_order_i = cuts.values[idx_cuts_order_i]
             new_tree = core_algorithm(
                 tree=tangles_tree,
-                current_cuts=cuts_order_i,
                 idx_current_cuts=idx_cuts_order_i,
             )
 
@@ -763,12 +900,11 @@ def get_hard_predictions(X: np.ndarray, agreement: int, verbose: int = 0):
 
     contracted.calculate_setP()
 
-    # soft predictions
-    weight = np.exp(-normalize(cuts.costs))
+    # soft predictions, kept in float64 as leaves can tie and float32 rounding would
+    # break those ties differently
+    weight = compute_weight(cuts.costs)
 
-    compute_soft_predictions_children(
-        node=contracted.root, cuts=cuts, weight=weight, verbose=verbose_bool
-    )
+    compute_soft_predictions_children(node=contracted.root, cuts=cuts, weight=weight)
     contracted.processed_soft_predictions = True
 
     ys_predicted, _ = compute_hard_predictions(contracted, verbose=verbose_bool)
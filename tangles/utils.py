@@ -1,4 +1,5 @@
 from __future__ import annotations
+from bitarray import util as bitarray_util
 import numpy as np
 from sklearn.manifold import TSNE
 from typing import Union, Optional
@@ -83,14 +84,31 @@ def normalize(array):
         return (array - np.min(array)) / np.ptp(array)
 
 
-def matching_items(d1, d2):
-    matching_keys = []
-    common_keys = d1.keys() & d2.keys()
-    for k in common_keys:
-        if d1[k] == d2[k]:
-            matching_keys.append(k)
+def compute_weight(costs):
+    """
+    Computes the weight exp(-normalize(costs)) of every cut
+
+    In the normal case the result is computed in place in a single array,
+    instead of allocating a new array for every step of the normalization.
+
+    Parameters
+    ----------
+    costs: ndarray
+        the costs of the cuts
 
-    return matching_keys
+    Returns
+    -------
+    ndarray
+        the weights of the cuts
+    """
+
+    ptp = np.ptp(costs)
+    if ptp == 0 or not np.isfinite(ptp):
+        weight = np.negative(normalize(costs), dtype=float)
+    else:
+        weight = np.subtract(costs, np.min(costs), dtype=float)
+        weight /= -ptp
+    return np.exp(weight, out=weight)
 
 
 def merge_dictionaries_with_disagreements(d1, d2):
@@ -149,7 +167,7 @@ def get_points_to_plot(xs, cs):
 
 
 def subset(a, b):
-    return (a & b).count() == a.count()
+    return bitarray_util.subset(a, b)
 
 
 def compute_hard_predictions(condensed_tree, verbose=True):
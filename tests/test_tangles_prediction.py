@@ -53,3 +53,58 @@ def test_simple_gaussians_performance():
         cuts.append(cut)
     pred = get_hard_predictions(np.concatenate(cuts).T, 10)
     assert np.all(pred == ys)
+
+
+def binary_matrix(rows):
+    return np.array([[int(c) for c in row] for row in rows])
+
+
+def test_tied_leaves_ab():
+    """
+    AB test on questionnaire answers where points are split evenly between leaves,
+    the ties have to be broken the same way as before.
+    """
+    X = binary_matrix([
+        "1111110101000",
+        "1001110101000",
+        "0111100100101",
+        "1111110001000",
+        "1101110101000",
+        "1111110100000",
+        "0101001010000",
+        "0101001010100",
+        "0101001010000",
+        "0101001000100",
+        "0111001010000",
+        "0100001010100",
+    ])
+    pred = get_hard_predictions(X, 5)
+    res_ab = np.array([1, 1, 0, 1, 1, 1, 0, 0, 0, 0, 0, 0])
+    assert np.all(pred == res_ab)
+
+
+def test_summation_order_ab():
+    """
+    AB test on questionnaire answers where the soft predictions of some points tie
+    exactly, the sums must not depend on the summation order of a BLAS routine.
+    """
+    X = binary_matrix([
+        "000001011010",
+        "000001111110",
+        "100001110110",
+        "100100111010",
+        "000011111011",
+        "100111001001",
+        "110111101101",
+        "010111001101",
+        "110110001101",
+        "100010001101",
+        "100001000111",
+        "110001011101",
+        "110001011101",
+        "110001011101",
+        "010011001100",
+    ])
+    pred = get_hard_predictions(X, 2)
+    res_ab = np.array([0, 0, 0, 0, 0, 0, 2, 2, 2, 2, 0, 1, 1, 1, 2])
+    assert np.all(pred == res_ab)
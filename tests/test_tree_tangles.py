@@ -0,0 +1,173 @@
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+
+from tangles.data_types import Cuts
+from tangles.tree_tangles import (
+    ContractedTangleNode,
+    ContractedTangleTree,
+    TangleNode,
+    compute_soft_predictions_children,
+    compute_soft_predictions_node,
+)
+from tangles.utils import Orientation
+
+
+def make_node(parent=None, cut_id=-1, orientation=None):
+    return TangleNode(
+        parent=parent,
+        right_child=None,
+        left_child=None,
+        is_left_child=orientation,
+        splitting=False,
+        did_split=False,
+        last_cut_added_id=cut_id,
+        last_cut_added_orientation=orientation,
+        tangle=None,
+    )
+
+
+def add_child(parent, cut_id, orientation):
+    child = make_node(parent, cut_id, orientation)
+    if orientation:
+        parent.left_child = child
+    else:
+        parent.right_child = child
+    parent.splitting = parent.left_child is not None and parent.right_child is not None
+    return child
+
+
+def make_tree():
+    """
+    Builds the tangle tree
+
+        root -> 0T -> 1T (leaf)
+                   -> 1F (leaf)
+             -> 0F -> 1T -> 2T -> 3T -> 4T -> 5T -> 6T (leaf)
+                                     -> 4F (leaf)
+    """
+    root = make_node()
+    a = add_child(root, 0, True)
+    add_child(a, 1, True)
+    add_child(a, 1, False)
+    b = add_child(root, 0, False)
+    for cut_id in (1, 2, 3):
+        b = add_child(b, cut_id, True)
+    b1 = b
+    for cut_id in (4, 5, 6):
+        b1 = add_child(b1, cut_id, True)
+    add_child(b, 4, False)
+    return SimpleNamespace(root=root, is_empty=False)
+
+
+def ids(nodes):
+    return [(node.last_cut_added_id, node.last_cut_added_orientation) for node in nodes]
+
+
+def test_contract_tree():
+    contracted = ContractedTangleTree(make_tree())
+
+    root = contracted.root
+    assert root.parent is None
+    assert ids([root.left_child, root.right_child]) == [(0, True), (3, True)]
+    assert ids([root.left_child.left_child, root.left_child.right_child]) == [
+        (1, True),
+        (1, False),
+    ]
+    assert ids([root.right_child.left_child, root.right_child.right_child]) == [
+        (6, True),
+        (4, False),
+    ]
+    assert root.right_child.left_child.parent is root.right_child
+    assert root.right_child.left_child.is_left_child is True
+    assert root.right_child.right_child.is_left_child is False
+
+    # leaves from left to right, splitting nodes after their children
+    assert ids(contracted.maximals) == [(1, True), (1, False), (6, True), (4, False)]
+    assert ids(contracted.splitting) == [(0, True), (3, True), (-1, None)]
+
+
+def test_contract_tree_deeper_than_recursion_limit():
+    depth = sys.getrecursionlimit() + 100
+    root = make_node()
+    node = root
+    for cut_id in range(depth):
+        add_child(node, cut_id, False)
+        node = add_child(node, cut_id, True)
+
+    contracted = ContractedTangleTree(SimpleNamespace(root=root, is_empty=False))
+
+    assert len(contracted.maximals) == depth + 1
+    assert len(contracted.splitting) == depth
+
+
+def test_prune_tree():
+    contracted = ContractedTangleTree(make_tree())
+    contracted.prune(1, verbose=False)
+
+    # Both leaves below 0T are pruned, 0T becomes a leaf, is visited again and is
+    # pruned as well. 4F is pruned, so 3T stops splitting and its remaining child
+    # 6T takes the place of the root.
+    assert ids([contracted.root]) == [(6, True)]
+    assert contracted.root.parent is None
+    assert contracted.root.is_leaf()
+    assert ids(contracted.maximals) == [(6, True)]
+    assert contracted.splitting == []
+
+
+def test_prune_tree_depth_zero_is_a_no_op():
+    contracted = ContractedTangleTree(make_tree())
+    contracted.prune(0, verbose=False)
+
+    assert ids(contracted.maximals) == [(1, True), (1, False), (6, True), (4, False)]
+    assert ids(contracted.splitting) == [(0, True), (3, True), (-1, None)]
+
+
+def make_contracted_split(characterizing_cuts_left, characterizing_cuts_right):
+    root = ContractedTangleNode(parent=None, node=make_node())
+    root.left_child = ContractedTangleNode(parent=root, node=make_node(root, 0, True))
+    root.right_child = ContractedTangleNode(
+        parent=root, node=make_node(root, 0, False)
+    )
+    root.characterizing_cuts_left = characterizing_cuts_left
+    root.characterizing_cuts_right = characterizing_cuts_right
+    return root
+
+
+def test_soft_predictions_points_on_no_side():
+    """
+    Points that are on no oriented side of the characterizing cuts get p = 0 exactly.
+    """
+    values = np.ones((8, 4), dtype=bool)
+    values[0, 3] = False
+    cuts = Cuts(values)
+    weight = np.array([1.0, 0.9, 0.4, 0.6, 0.5, 0.3, 0.6, 1.0])
+    all_right = {i: Orientation(False) for i in range(8)}
+    root = make_contracted_split(all_right, dict(all_right))
+
+    compute_soft_predictions_children(root, cuts, weight)
+
+    assert np.all(root.left_child.p == np.array([0, 0, 0, 0.5]))
+    assert np.all(root.right_child.p == np.array([0, 0, 0, 0.5]))
+
+
+def test_compute_soft_predictions_node():
+    values = np.array([[1, 1, 0, 0], [0, 1, 1, 0], [1, 0, 1, 1]], dtype=bool)
+    cuts = Cuts(values)
+    weight = np.array([0.5, 0.25, 2.0])
+    characterizing_cuts = {
+        0: Orientation(True),
+        1: Orientation(False),
+        2: Orientation("both"),
+    }
+
+    expected = values[0] * 0.5 + ~values[1] * 0.25
+    assert np.array_equal(
+        compute_soft_predictions_node(characterizing_cuts, cuts, weight), expected
+    )
+    out = np.empty(4)
+    compute_soft_predictions_node(characterizing_cuts, cuts, weight, out=out)
+    assert np.array_equal(out, expected)
+
+    assert np.array_equal(compute_soft_predictions_node({}, cuts, weight), np.zeros(4))
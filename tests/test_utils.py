@@ -0,0 +1,31 @@
+import numpy as np
+
+from tangles.utils import compute_weight, normalize
+
+
+def test_compute_weight():
+    costs = np.array([0.3, 2.5, 1.0, 0.3, 7.25])
+    weight = compute_weight(costs)
+    assert weight.dtype == np.float64
+    assert np.array_equal(weight, np.exp(-normalize(costs)))
+    # the costs are not modified in place
+    assert np.array_equal(costs, np.array([0.3, 2.5, 1.0, 0.3, 7.25]))
+
+
+def test_compute_weight_constant_costs():
+    costs = np.array([2.0, 2.0, 2.0])
+    assert np.array_equal(compute_weight(costs), np.exp(-normalize(costs)))
+    assert np.all(compute_weight(costs) == np.exp(-1))
+
+
+def test_compute_weight_infinite_costs():
+    costs = np.array([1.0, np.inf, 3.0])
+    assert np.array_equal(compute_weight(costs), np.exp(-normalize(costs)))
+    assert np.array_equal(costs, np.array([1.0, np.inf, 3.0]))
+
+
+def test_compute_weight_integer_costs():
+    for costs in [np.array([4, 1, 3, 1]), np.array([5, 5])]:
+        weight = compute_weight(costs)
+        assert weight.dtype == np.float64
+        assert np.array_equal(weight, np.exp(-normalize(costs)))